@@ -1,25 +1,60 @@
 #!/usr/bin/env python3
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from concurrent.futures import ThreadPoolExecutor
 from iso3166 import countries_by_alpha2
 from sys import stderr as STREAM
+from functools import lru_cache, partial
 from datetime import datetime
-from io import BytesIO
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from urllib3.exceptions import ResponseError
 from tqdm import tqdm
 import ipaddress
+import requests_cache
 import requests
 import argparse
 import pycurl
-import math
-import re
+import threading
+import socket
+import queue
+import collections
+import time
+import os
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 rir_stat_urls = {
-    "ripe": "ftp://ftp.ripe.net/pub/stats/ripencc/delegated-ripencc-extended-latest",
-    "afrinic": "ftp://ftp.afrinic.net/pub/stats/afrinic/delegated-afrinic-extended-latest",
-    "apnic": "ftp://ftp.apnic.net/pub/stats/apnic/delegated-apnic-extended-latest",
-    "lacnic": "ftp://ftp.lacnic.net/pub/stats/lacnic/delegated-lacnic-extended-latest",
-    "arin": "ftp://ftp.arin.net/pub/stats/arin/delegated-arin-extended-latest"
+    "ripe": "https://ftp.ripe.net/pub/stats/ripencc/delegated-ripencc-extended-latest",
+    "afrinic": "https://ftp.afrinic.net/pub/stats/afrinic/delegated-afrinic-extended-latest",
+    "apnic": "https://ftp.apnic.net/stats/apnic/delegated-apnic-extended-latest",
+    "lacnic": "https://ftp.lacnic.net/pub/stats/lacnic/delegated-lacnic-extended-latest",
+    "arin": "https://ftp.arin.net/pub/stats/arin/delegated-arin-extended-latest"
 }
 
+max_workers = 40
+
+# Seconds to cache whois answers without records
+negative_cache_ttl = 3600
+
+# Number of addresses in an IPv6 block of each prefix length
+num_of_ipv6_by_len = [1 << (128 - length) for length in range(129)]
+
+cache_dir = os.path.join(os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache"), "rir-ip-info")
+
+def positive_int(value: str) -> int:
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"{value} is not a positive integer")
+    return number
+
+def non_negative_int(value: str) -> int:
+    number = int(value)
+    if number < 0:
+        raise argparse.ArgumentTypeError(f"{value} is not a non-negative integer")
+    return number
+
 def init_argparse() -> argparse.ArgumentParser:
     parser = argparse.ArgumentParser(
         usage="%(prog)s [OPTION]",
@@ -32,138 +67,507 @@ def init_argparse() -> argparse.ArgumentParser:
     parser.add_argument('-t', '--prefix_type', type=str.lower, choices=["allocated", "assigned"], nargs='+', required=True)
     parser.add_argument('-o', '--org_info', type=str.lower, choices=["netname", "status"], nargs='+', required=False, default=[])
     parser.add_argument('-p', '--progress', action='store_true', required=False, default=False)
+    parser.add_argument('-w', '--workers', type=positive_int, required=False, default=max_workers)
+    parser.add_argument('--cache-ttl', type=non_negative_int, required=False, default=86400, metavar='SECONDS')
+    parser.add_argument('--no-cache', dest='cache_ttl', action='store_const', const=0)
+    parser.add_argument('--refresh', action='store_true', required=False, default=False)
     return parser
 
-def prefix_len_by_num_of_ip(num_of_ip: int) -> list:
+# Delegations use only a handful of distinct sizes, so remember the split for each
+@lru_cache(maxsize=64)
+def prefix_len_by_num_of_ip(num_of_ip: int) -> tuple:
     prefixes = []
-    log2 = math.log2(num_of_ip)
-    bits_needed = math.floor(log2)
-    prefixes.append(32 - bits_needed)
-    if log2 != bits_needed:
-        remainder_num_of_ip = num_of_ip - (2 ** bits_needed)
-        prefixes.extend(prefix_len_by_num_of_ip(remainder_num_of_ip))
-    return prefixes
-
-def fetch_ripe_whois(prefix_notation: str) -> dict:
+    # One CIDR block per set bit, largest block first
+    while num_of_ip:
+        bits_needed = num_of_ip.bit_length() - 1
+        prefixes.append(32 - bits_needed)
+        num_of_ip -= 1 << bits_needed
+    return tuple(prefixes)
+
+class ThrottledHTTPAdapter(HTTPAdapter):
+    # Caps concurrent requests, halving the cap when the server keeps rate limiting
+    # and raising it again by one after each full round of successful requests
+    backoff_cooldown = 10
+
+    def __init__(self, max_concurrency: int, **kwargs) -> None:
+        super().__init__(**kwargs)
+        self.max_concurrency = self.concurrency = max_concurrency
+        self.active = 0
+        self.successes = 0
+        self.throttled_at = 0.0
+        self.condition = threading.Condition()
+
+    def send(self, request, *args, **kwargs):
+        with self.condition:
+            self.condition.wait_for(lambda: self.active < self.concurrency)
+            self.active += 1
+
+        throttled = False
+        try:
+            response = super().send(request, *args, **kwargs)
+            if retries := getattr(response.raw, 'retries', None):
+                throttled = any(attempt.status == 429 for attempt in retries.history)
+            return response
+        except requests.exceptions.RetryError as error:
+            # Still failing after every retry, which only means rate limiting if the last answer was a 429
+            reason = getattr(error.args[0], 'reason', None) if error.args else None
+            throttled = str(reason) == ResponseError.SPECIFIC_ERROR.format(status_code=429)
+            raise
+        finally:
+            self.release(throttled)
+
+    def release(self, throttled: bool) -> None:
+        with self.condition:
+            self.active -= 1
+            now = time.monotonic()
+            if throttled:
+                self.successes = 0
+                # Back off once per cooldown, not once per request that saw the 429
+                if self.concurrency > 1 and now - self.throttled_at > self.backoff_cooldown:
+                    self.concurrency = max(1, self.concurrency // 2)
+                    self.throttled_at = now
+                    tqdm.write(f"RIPEstat is rate limiting, lowering concurrency to {self.concurrency}", file=STREAM)
+            elif self.concurrency < self.max_concurrency:
+                self.successes += 1
+                if self.successes >= self.concurrency:
+                    self.concurrency += 1
+                    self.successes = 0
+            self.condition.notify_all()
+
+def init_session(cache_ttl: int, workers: int = max_workers) -> requests.Session:
+    if cache_ttl > 0:
+        # Whois data changes over days/weeks, keep responses on disk between runs
+        os.makedirs(cache_dir, exist_ok=True)
+        session = requests_cache.CachedSession(
+            os.path.join(cache_dir, "whois"),
+            backend="sqlite",
+            expire_after=cache_ttl
+        )
+    else:
+        session = requests.Session()
+
+    # One pooled connection per worker thread, so TLS handshakes are reused across lookups.
+    # Rate limited and failed requests are retried, honouring Retry-After
+    retries = Retry(
+        total=5,
+        backoff_factor=1.0,
+        status_forcelist=[429, 500, 502, 503, 504],
+        allowed_methods=["GET"],
+        respect_retry_after_header=True
+    )
+    session.mount("https://", ThrottledHTTPAdapter(
+        workers, pool_connections=workers, pool_maxsize=workers, max_retries=retries
+    ))
+    return session
+
+def fetch_ripe_whois(session: requests.Session, prefix_notation: str) -> dict:
     url = f"https://stat.ripe.net/data/whois/data.json?resource={prefix_notation}"
     try:
-        response = requests.get(url, timeout=10)
-    except:
+        response = session.get(url, timeout=10)
+        response.raise_for_status()
+    except requests.RequestException:
         return None
 
     # Free unused
     del url
-    response.raise_for_status()
-    response_json = response.json()
-
-    # Free unused
-    del response
-
-    if response_json.get('status') == "ok" and response_json.get('status_code') == 200:
-        return response_json['data']
+    try:
+        response_json = orjson.loads(response.content) if orjson else response.json()
+    except ValueError:
+        # Not JSON, e.g. a maintenance page served with status 200
+        response_json = None
+
+    if isinstance(response_json, dict) and response_json.get('status') == "ok" and response_json.get('status_code') == 200:
+        data = response_json.get('data')
+        if isinstance(data, dict) and data.get('records'):
+            return data
+
+    # Keep empty or unreadable answers only briefly, so a transient RIPEstat hiccup is retried soon
+    if isinstance(session, requests_cache.CachedSession) and not response.from_cache:
+        expires = requests_cache.get_expiration_datetime(min(negative_cache_ttl, session.settings.expire_after))
+        session.cache.save_response(response, expires=expires)
     return None
 
-def fetch_organization_info(prefix_notation: str, org_info: dict) -> dict:
-    info_fields = list(org_info.keys())
-    if whois := fetch_ripe_whois(prefix_notation):
-        for record in whois['records']:
-            for entry in record:
-                for field in info_fields:
-                    if entry.get('key') == field:
-                        org_info[field] = entry.get('value', 'Unknown')
-                        info_fields.remove(field)
-                        break
+def fetch_organization_info(session: requests.Session, prefix_notation: str, org_info: dict) -> dict:
+    info_fields = set(org_info.keys())
+    if whois := fetch_ripe_whois(session, prefix_notation):
+        # Walk every entry of every record in one flat pass
+        entries = (entry for record in whois['records'] for entry in record)
+        for entry in entries:
+            field = entry.get('key')
+            if field in info_fields:
+                org_info[field] = entry.get('value', 'Unknown')
+                info_fields.discard(field)
+                # Stop walking the response once every field is found
+                if not info_fields:
+                    break
     return org_info
 
-
-def process_ip_range(ip_address: str, length: int, org_info_fields: list) -> list:
-    ip_version = ipaddress.ip_address(ip_address).version
-
-    if ip_version == 4:
-        length_list = prefix_len_by_num_of_ip(length)
-    else:
-        length_list = [length]
-
+def fetch_organization_info_batch(session: requests.Session, prefix_batch: list, org_info_fields: list) -> list:
+    return [
+        (prefix, fetch_organization_info(session, prefix, dict.fromkeys(org_info_fields)))
+        for prefix in prefix_batch
+    ]
+
+class OrganizationInfoLookup:
+    # Looks up organization info on a thread pool while the dumps are still being parsed,
+    # and hands every prefix to on_ready once the info for its delegation is known
+    def __init__(self, session: requests.Session, org_info_fields: list, on_ready, workers: int = max_workers) -> None:
+        self.session = session
+        self.org_info_fields = org_info_fields
+        self.on_ready = on_ready
+        self.workers = workers
+        # Cap on submitted batches, so futures do not pile up faster than lookups finish
+        self.max_in_flight = workers * 4
+
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.done = queue.SimpleQueue()
+        self.futures = set()
+        # Prefixes not submitted yet because max_in_flight batches are already running
+        self.waiting = collections.deque()
+        # Prefixes waiting for organization information, keyed by lookup prefix
+        self.pending = {}
+        self.org_info_map = {}
+        self.progress_bar = tqdm(total=0, desc="Fetching organization information...")
+
+    def add(self, ip_info: dict) -> None:
+        lookup_prefix = ip_info["lookup_prefix"]
+        if lookup_prefix in self.org_info_map:
+            ip_info.update(self.org_info_map[lookup_prefix])
+            self.on_ready(ip_info)
+            return
+
+        # RIPEstat whois takes a single resource per call, so look up each distinct prefix once
+        if lookup_prefix not in self.pending:
+            self.pending[lookup_prefix] = []
+            self.progress_bar.total += 1
+            self.waiting.append(lookup_prefix)
+            self.submit()
+        self.pending[lookup_prefix].append(ip_info)
+
+    def submit(self) -> None:
+        # Never waits, add runs inside the download's write callback. Prefixes beyond
+        # max_in_flight batches stay in waiting until poll sees batches finish
+        while self.waiting and len(self.futures) < self.max_in_flight:
+            # Batch prefixes to cut per-task executor overhead, but keep each batch to a small
+            # share of the backlog, so the last batches are single prefixes and no worker idles
+            batch_size = max(1, min(64, len(self.waiting) // (self.workers * 4)))
+            batch = [self.waiting.popleft() for _ in range(batch_size)]
+            future = self.executor.submit(fetch_organization_info_batch, self.session, batch, self.org_info_fields)
+            future.add_done_callback(self.done.put)
+            self.futures.add(future)
+
+    def poll(self, block: bool = False) -> None:
+        # Hand out the results of finished batches, waiting for one if block is set
+        while self.futures:
+            try:
+                future = self.done.get(block=block)
+            except queue.Empty:
+                break
+            self.futures.discard(future)
+            block = False
+
+            batch = future.result()
+            for lookup_prefix, org_info in batch:
+                self.org_info_map[lookup_prefix] = org_info
+                for ip_info in self.pending.pop(lookup_prefix):
+                    ip_info.update(org_info)
+                    self.on_ready(ip_info)
+            self.progress_bar.update(len(batch))
+        self.submit()
+
+    def finish(self) -> None:
+        while self.futures:
+            self.poll(block=True)
+
+    def close(self) -> None:
+        self.waiting.clear()
+        # shutdown(cancel_futures=True) needs Python 3.9, drop the queued lookups by hand
+        for future in self.futures:
+            future.cancel()
+        # Do not wait for lookups already running, their results are no longer needed
+        self.executor.shutdown(wait=False)
+        self.progress_bar.close()
+
+
+# inet_aton/inet_ntoa do the dotted-quad parsing and formatting in C
+def ipv4_to_int(ip_address: str) -> int:
+    return int.from_bytes(socket.inet_aton(ip_address), 'big')
+
+def int_to_ipv4(ip_int: int) -> str:
+    return socket.inet_ntoa(ip_int.to_bytes(4, 'big'))
+
+def ipv6_to_int(ip_address: str) -> int:
+    return int.from_bytes(socket.inet_pton(socket.AF_INET6, ip_address), 'big')
+
+def int_to_ipv6(ip_int: int) -> str:
+    # inet_ntop writes IPv4-compatible/mapped addresses in dotted form, ipaddress does not
+    if ip_int >> 32 in (0, 0xffff):
+        return str(ipaddress.IPv6Address(ip_int))
+    return socket.inet_ntop(socket.AF_INET6, ip_int.to_bytes(16, 'big'))
+
+def process_ip_range(ip_address: str, length: int) -> list:
     json_list = []
-    next_ip = curr_ip = ipaddress.ip_address(ip_address)
-    for len in length_list:
 
-        if ip_version == 4:
-            num_of_ip = 2 ** (32 - len)
-            curr_ip = next_ip
-            next_ip = ipaddress.ip_address(next_ip) + num_of_ip
-
-        prefix_notation = ipaddress.ip_network((curr_ip, len), strict=False)
+    if ':' in ip_address:
+        # IPv6 rows already carry the prefix length
+        # Mask host bits, same as ip_network(..., strict=False)
+        network_int = ipv6_to_int(ip_address) & ~((1 << (128 - length)) - 1)
+        prefix_notation = f"{int_to_ipv6(network_int)}/{length}"
+        json = {
+            "prefix_notation": prefix_notation,
+            "lookup_prefix": prefix_notation,
+            "length": length,
+            "version": 6
+        }
+        json_list.append(json)
+        return json_list
 
-        org_info = dict()
-        for key in org_info_fields:
-            org_info[key] = None
+    # IPv4 rows carry a number of addresses, split it into CIDR blocks
+    next_ip = ipv4_to_int(ip_address)
+    lookup_prefix = None
+    for len in prefix_len_by_num_of_ip(length):
+        num_of_ip = 1 << (32 - len)
+        # Mask host bits, same as ip_network(..., strict=False)
+        curr_ip = next_ip & ~(num_of_ip - 1)
+        next_ip += num_of_ip
 
-        if org_info_fields:
-            org_info = fetch_organization_info(str(prefix_notation), org_info)
+        prefix_notation = f"{int_to_ipv4(curr_ip)}/{len}"
+        # All blocks of one delegation share its whois object, look it up by the first block
+        lookup_prefix = lookup_prefix or prefix_notation
 
         json = {
             "prefix_notation": prefix_notation,
+            "lookup_prefix": lookup_prefix,
             "length": len,
-            "version": ip_version
+            "version": 4
         }
-        json.update(org_info)
         json_list.append(json)
-    
-    return json_list
 
-def prefix_info_list_to_file(ip_info_list: list, org_info_fields: list, filename: str) -> None:
-    total_ip_addresses = 0
-    with open(filename, 'w') as file:
-        for ip_info in ip_info_list:
-            line = str(ip_info["prefix_notation"])
-            for field in org_info_fields:
-                line += f" | {ip_info[field]}"
-            
-            if ip_info['version'] == 4:
-                total_ip_addresses += 2**(32 - ip_info['length'])
-            else:
-                total_ip_addresses += 2**(128 - ip_info['length'])
+    return json_list
 
-            file.write(f"{line}\n")
-            # Print the total number of IP addresses
-        file.write(f"Total IP addresses: {total_ip_addresses}")
+def num_of_ip_in_range(ip_address: str, value: int) -> int:
+    # IPv4 rows carry the number of addresses, IPv6 rows a prefix length
+    if ':' in ip_address:
+        return num_of_ipv6_by_len[value]
+    return value
+
+class PrefixInfoWriter:
+    # Writes each prefix as soon as it is ready, followed by the address total.
+    # The file is only created on the first write, so a failed download leaves no empty result
+    def __init__(self, filename: str, org_info_fields: list, chunk_size: int = 10000) -> None:
+        self.filename = filename
+        self.file = None
+        self.org_info_fields = org_info_fields
+        self.chunk_size = chunk_size
+        self.lines = []
+
+    def write(self, ip_info: dict) -> None:
+        fields = [ip_info["prefix_notation"]]
+        fields.extend(str(ip_info[field]) for field in self.org_info_fields)
+        self.lines.append(" | ".join(fields) + "\n")
+
+        if len(self.lines) >= self.chunk_size:
+            self.flush()
+
+    def open(self):
+        if self.file is None:
+            self.file = open(self.filename, 'w', buffering=1 << 20)
+        return self.file
+
+    def flush(self) -> None:
+        if self.lines:
+            self.open().writelines(self.lines)
+            self.lines.clear()
+
+    def write_total(self, total_ip_addresses: int) -> None:
+        self.flush()
+        # Print the total number of IP addresses
+        self.open().write(f"Total IP addresses: {total_ip_addresses}")
+
+    def close(self) -> None:
+        self.flush()
+        if self.file is not None:
+            self.file.close()
 
 # callback function for c.XFERINFOFUNCTION
-def status(download_t, download_d, upload_t, upload_d) -> None:
+def status(name, download_t, download_d, upload_t, upload_d) -> None:
     # use kiB's
     kb = 1024
 
-    STREAM.write('Downloading: {}/{} kiB ({}%)\r'.format(
+    STREAM.write('Downloading {}: {}/{} kiB ({}%)\r'.format(
+        name,
         str(int(download_d/kb)),
         str(int(download_t/kb)),
         str(int(download_d/download_t*100) if download_t > 0 else 0)
     ))
     STREAM.flush()
 
-def fetch(url: str, progress: bool = None) -> bytes:
-    b_obj = BytesIO() 
+class LineBuffer:
+    # Collects downloaded chunks and hands complete lines (as bytes) to consumer
+    def __init__(self, consumer) -> None:
+        self.consumer = consumer
+        self.tail = b""
+
+    def feed(self, chunk: bytes) -> None:
+        lines = (self.tail + chunk).split(b"\n")
+        # Last item is a partial line until the next chunk (or close) arrives
+        self.tail = lines.pop()
+        for line in lines:
+            self.consumer(line)
+
+    def close(self) -> None:
+        if self.tail:
+            self.consumer(self.tail)
+        self.tail = b""
+
+def init_curl(url: str, progress_name: str = None) -> pycurl.Curl:
     crl = pycurl.Curl() 
 
     # Set URL value
     crl.setopt(crl.URL, url)
 
-    # Write bytes that are utf-8 encoded
-    crl.setopt(crl.WRITEDATA, b_obj)
+    # Fail on HTTP errors instead of parsing an error page
+    crl.setopt(crl.FOLLOWLOCATION, True)
+    crl.setopt(crl.FAILONERROR, True)
+
+    # Dumps are hundreds of MB, read them in 512 KiB chunks over a kept-alive connection
+    crl.setopt(crl.BUFFERSIZE, 512 * 1024)
+    crl.setopt(crl.TCP_KEEPALIVE, 1)
 
-    if progress:
+    if progress_name:
         # display progress
         crl.setopt(crl.NOPROGRESS, False)
-        crl.setopt(crl.XFERINFOFUNCTION, status)
-
-    # Perform a file transfer 
-    crl.perform() 
-
-    # End curl session
-    crl.close()
+        crl.setopt(crl.XFERINFOFUNCTION, partial(status, progress_name))
+
+    return crl
+
+class CachedDownload:
+    # Streams url to write while keeping a copy in cache_dir. On later runs the
+    # request is conditional, and the copy is replayed if the file has not changed
+    def __init__(self, url: str, write, refresh: bool = False) -> None:
+        self.url = url
+        self.write = write
+        self.path = os.path.join(cache_dir, os.path.basename(url))
+        self.etag_path = f"{self.path}.etag"
+        self.use_cache = not refresh and os.path.exists(self.path)
+        self.etag = None
+        self.part = None
+        # Exception raised while handling a chunk, re-raised by fetch
+        self.error = None
+
+    def setup(self, crl: pycurl.Curl) -> None:
+        # Hand received bytes to feed as they arrive
+        crl.setopt(crl.WRITEFUNCTION, self.feed)
+        crl.setopt(crl.HEADERFUNCTION, self.header)
+        # Ask for the server's Last-Modified, used as the mtime of the cached copy
+        crl.setopt(crl.OPT_FILETIME, True)
+
+        if self.use_cache:
+            crl.setopt(crl.TIMECONDITION, crl.TIMECONDITION_IFMODSINCE)
+            crl.setopt(crl.TIMEVALUE, int(os.path.getmtime(self.path)))
+            if os.path.exists(self.etag_path):
+                with open(self.etag_path) as file:
+                    crl.setopt(crl.HTTPHEADER, [f"If-None-Match: {file.read().strip()}"])
+
+    def header(self, line: bytes) -> None:
+        # A new status line starts the headers of the next response (e.g. after a redirect)
+        if line.startswith(b"HTTP/"):
+            self.etag = None
+        elif line.lower().startswith(b"etag:"):
+            self.etag = line[5:].strip().decode('latin-1')
+
+    def feed(self, chunk: bytes) -> int:
+        # pycurl only prints exceptions raised here and fails with a generic write error,
+        # so keep the exception (Ctrl-C included) and stop the transfer by returning 0
+        try:
+            if self.part is None:
+                os.makedirs(cache_dir, exist_ok=True)
+                self.part = open(f"{self.path}.part", 'wb')
+            self.part.write(chunk)
+            self.write(chunk)
+        except BaseException as error:
+            self.error = error
+            return 0
+
+    def finish(self, crl: pycurl.Curl) -> None:
+        if self.use_cache and (crl.getinfo(crl.RESPONSE_CODE) == 304 or crl.getinfo(crl.CONDITION_UNMET)):
+            # Not modified, replay the cached copy
+            self.abort()
+            with open(self.path, 'rb') as file:
+                for chunk in iter(partial(file.read, 512 * 1024), b""):
+                    self.write(chunk)
+            return
+
+        if self.part is None:
+            return
+        self.part.close()
+        os.replace(f"{self.path}.part", self.path)
+        if (filetime := crl.getinfo(crl.INFO_FILETIME)) > 0:
+            os.utime(self.path, (filetime, filetime))
+
+        if self.etag:
+            with open(self.etag_path, 'w') as file:
+                file.write(self.etag)
+        elif os.path.exists(self.etag_path):
+            os.remove(self.etag_path)
+
+    def abort(self) -> None:
+        if self.part is not None:
+            self.part.close()
+            os.remove(f"{self.path}.part")
+            self.part = None
+
+def fetch(downloads: dict, progress: bool = None) -> None:
+    # downloads maps a name to its CachedDownload, all transfers run concurrently
+    multi = pycurl.CurlMulti()
+    handles = []
+    for name, download in downloads.items():
+        crl = init_curl(download.url, name if progress else None)
+        download.setup(crl)
+        multi.add_handle(crl)
+        handles.append((crl, download))
+
+    # Perform the file transfers
+    num_handles = len(handles)
+    error = None
+    while num_handles:
+        ret, num_handles = multi.perform()
+        if ret == pycurl.E_CALL_MULTI_PERFORM:
+            continue
+        # Stop every transfer once handling one of them has failed
+        if error := next((download.error for download in downloads.values() if download.error), None):
+            break
+        if num_handles:
+            multi.select(1.0)
+
+    _, _, failed = multi.info_read()
 
-    # Get the content stored in the BytesIO object (in byte characters) 
-    return b_obj.getvalue()
+    try:
+        for crl, download in handles:
+            if error or failed:
+                download.abort()
+            else:
+                download.finish(crl)
+    finally:
+        # End curl sessions
+        for crl, _ in handles:
+            multi.remove_handle(crl)
+            crl.close()
+        multi.close()
+
+    if error:
+        raise error
+    if failed:
+        _, errno, errmsg = failed[0]
+        raise pycurl.error(errno, errmsg)
+
+def parse_delegated_line(line: bytes, cc_set: set, ver_set: set, type_set: set) -> tuple:
+    # registry|cc|type|start|value|date|status[|opaque-id[|extensions...]]
+    # Compare raw bytes and only decode the fields of matching lines
+    parts = line.split(b'|', 7)
+    if len(parts) >= 7 and parts[1] in cc_set and parts[2] in ver_set and parts[6] in type_set:
+        return parts[3].decode('ascii'), int(parts[4])
+    return None
 
 
 def main() -> None:
@@ -171,47 +575,65 @@ def main() -> None:
     parser = init_argparse()
     args = parser.parse_args()
 
-    # Convert list to piped string for regex
-    country_code = ""
-    if len(args.country_code) != 1:
-        for cc in args.country_code[:-1]:
-            country_code += f"{cc}|"
-    country_code += args.country_code[-1]
-
-    ip_version = ""
-    if len(args.ip_version) != 1:
-        for version in args.ip_version[:-1]:
-            ip_version += f"{version}|"
-    ip_version += str(args.ip_version[-1])
-
-    prefix_type = ""
-    if len(args.prefix_type) != 1:
-        for type in args.prefix_type[:-1]:
-            prefix_type += f"{type}|"
-    prefix_type += args.prefix_type[-1]
-    
-    regex = f"(.*?)\|({country_code})\|(ipv{ip_version})\|(.*?)\|(.*?)\|(.*?)\|({prefix_type})\|(.*?)"
-
-    records = []
-    for rir in args.rir:
-        data = fetch(rir_stat_urls[rir], progress=args.progress).decode('utf8')
-        regex_match = re.findall(regex, data)
-        records.extend(regex_match)
-    # Free memory
-    del data, regex_match
-
-    results = []
-    # Use ThreadPoolExecutor to fetch data concurrently
-    with ThreadPoolExecutor(max_workers=40) as executor:
-        futures = [executor.submit(process_ip_range, record[3], int(record[4]), args.org_info) for record in records]
-        progress_desc = f"Processing data from retrieved Database..."
-        for future in tqdm(as_completed(futures), total=len(futures), desc=progress_desc):
-            results.extend(future.result())
-
-        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-        filename = f"results_{timestamp}.txt"
-        prefix_info_list_to_file(results, args.org_info, filename)
-        print(f"Results have been written to {filename}")
+    # Sets of accepted values for each filtered column, as bytes to match the raw dump lines
+    cc_set = {cc.encode() for cc in args.country_code}
+    ver_set = {f"ipv{version}".encode() for version in args.ip_version}
+    type_set = {prefix_type.encode() for prefix_type in args.prefix_type}
+
+    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+    filename = f"results_{timestamp}.txt"
+    writer = PrefixInfoWriter(filename, args.org_info)
+
+    # Only the network-bound whois lookups go to the thread pool, and they
+    # start as soon as a delegation is parsed, overlapping the downloads
+    lookup = None
+    if args.org_info:
+        session = init_session(args.cache_ttl, args.workers)
+        lookup = OrganizationInfoLookup(session, args.org_info, writer.write, args.workers)
+
+    total_ip_addresses = 0
+
+    # Parsing and CIDR splitting are cheap, do them inline as lines arrive
+    def process_line(line: bytes) -> None:
+        nonlocal total_ip_addresses
+        if record := parse_delegated_line(line, cc_set, ver_set, type_set):
+            start, value = record
+            # Count the whole delegation once, instead of summing its blocks on output
+            total_ip_addresses += num_of_ip_in_range(start, value)
+            for ip_info in process_ip_range(start, value):
+                if lookup:
+                    lookup.add(ip_info)
+                else:
+                    writer.write(ip_info)
+            if lookup:
+                lookup.poll()
+
+    try:
+        # Download the dumps concurrently and parse them while they arrive,
+        # never holding a whole file in memory
+        line_buffers = {rir: LineBuffer(process_line) for rir in args.rir}
+        fetch(
+            {
+                rir: CachedDownload(rir_stat_urls[rir], line_buffer.feed, refresh=args.refresh)
+                for rir, line_buffer in line_buffers.items()
+            },
+            progress=args.progress
+        )
+        for line_buffer in line_buffers.values():
+            line_buffer.close()
+
+        if lookup:
+            lookup.finish()
+        writer.write_total(total_ip_addresses)
+    finally:
+        try:
+            # Keep whatever was resolved so far if the run is interrupted
+            writer.close()
+        finally:
+            if lookup:
+                lookup.close()
+
+    print(f"Results have been written to {filename}")
 
 if __name__ == "__main__":
     main()